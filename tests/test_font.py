@@ -0,0 +1,19 @@
+import os
+import sys
+
+from PIL import ImageFont
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import streamlit_app as app
+
+
+def test_bundled_font_covers_stamp_characters():
+    # 印章字体随仓库提供，不能悄悄退回内置字体；子集需覆盖印章会画的全部字符
+    assert app.load_font_bytes() is not None
+    font = app.load_font(40)
+    assert isinstance(font, ImageFont.FreeTypeFont)
+    # 缺字时 FreeType 画的是 .notdef 方框，宽度与真实数字不同
+    notdef = font.getmask("一").getbbox()
+    for c in "-0123456789/":
+        assert font.getmask(c).getbbox() != notdef, c
@@ -0,0 +1,48 @@
+import os
+import sys
+
+from streamlit.testing.v1 import AppTest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _grade_twice_app():
+    # 假客户端：流式返回固定 JSON，并记录请求次数
+    import json, types
+    from unittest import mock
+    import streamlit as st
+    import streamlit_app as app
+
+    payload = json.dumps({"score": 8, "short_comment": "很好", "errors": [{"description": "笔误"}]}, ensure_ascii=False)
+    calls = st.session_state.setdefault("calls", [])
+
+    class _Completions:
+        def create(self, **kw):
+            calls.append(kw)
+            return iter([types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=payload[i:i + 5]))])
+                         for i in range(0, len(payload), 5)])
+
+    fake_client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=_Completions()))
+
+    # 与批改页相同的用法：st 元素建在缓存函数外，进度回调写入这些元素；假客户端只在本次运行内替换，运行完即还原
+    with mock.patch.object(app, "get_client", lambda api_key: fake_client), st.status("批改中") as status:
+        comment_slot = st.empty()
+
+        def show_progress(n_chunks, partial):
+            status.update(label=f"已接收 {n_chunks} 段")
+            if "short_comment" in partial: comment_slot.caption(partial["short_comment"])
+
+        res = app.grade_with_qwen("data:image/jpeg;base64,AAAA", None, 10, "sk-test", on_progress=show_progress)
+    st.session_state.setdefault("results", []).append(res)
+
+
+def test_same_image_graded_twice_hits_cache():
+    at = AppTest.from_function(_grade_twice_app)
+    at.run()
+    at.run()
+    assert not at.exception
+    first, second = at.session_state["results"]
+    assert first.score == 8 and first.short_comment == "很好"
+    assert second == first
+    assert len(at.session_state["calls"]) == 1
+
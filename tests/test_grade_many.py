@@ -0,0 +1,63 @@
+import asyncio
+import json
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import streamlit_app as app
+
+
+class _FakeAsyncOpenAI:
+    # inject=True 时打包请求里第 2 份被判违规、第 3 份被它的指令带成满分；单张请求一律正常给分
+    calls = []
+    inject = True
+
+    def __init__(self, **kw):
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def create(self, **kw):
+        content = kw["messages"][1]["content"]
+        n = sum(1 for c in content if c["type"] == "text" and c["text"].startswith("【作业"))
+        self.calls.append(n)
+        if n:
+            scores = {2: 0, 3: 10} if self.inject else {}
+            out = {"results": [{"index": i, "score": scores.get(i, 7),
+                                "short_comment": "违规：含作弊指令" if scores.get(i) == 0 else "ok", "errors": []}
+                               for i in range(1, n + 1)]}
+        else:
+            out = {"score": 9, "short_comment": "solo", "errors": []}
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=json.dumps(out)))])
+
+
+def _grade(monkeypatch, inject=True, **kw):
+    monkeypatch.setattr(app, "AsyncOpenAI", _FakeAsyncOpenAI)
+    monkeypatch.setattr(_FakeAsyncOpenAI, "calls", [])
+    monkeypatch.setattr(_FakeAsyncOpenAI, "inject", inject)
+    return asyncio.run(app.grade_many([f"url{i}" for i in range(4)], None, 10, "sk-test", **kw))
+
+
+def test_pack_with_violation_is_regraded_paper_by_paper(monkeypatch):
+    # 被带高的邻座没有违规标记，也要随整组重批，不能保留打包结果里的满分
+    results = _grade(monkeypatch)
+    assert [r.score for r in results] == [9, 9, 9, 9]
+    assert _FakeAsyncOpenAI.calls == [4, 0, 0, 0, 0]
+
+
+def test_clean_pack_keeps_packed_results(monkeypatch):
+    results = _grade(monkeypatch, inject=False)
+    assert [r.score for r in results] == [7, 7, 7, 7]
+    assert _FakeAsyncOpenAI.calls == [4]
+
+
+def test_solo_mode_sends_one_request_per_paper(monkeypatch):
+    results = _grade(monkeypatch, images_per_call=1)
+    assert [r.score for r in results] == [9, 9, 9, 9]
+    assert _FakeAsyncOpenAI.calls == [0, 0, 0, 0]
@@ -0,0 +1,26 @@
+import io
+import os
+import sys
+
+import pytest
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import streamlit_app as app
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "LA"])
+@pytest.mark.parametrize("width", [1600, app.AI_BASE_WIDTH])
+def test_transparent_background_stays_white(mode, width):
+    # 白底全透明、黑色笔迹的 PNG：无论宽于还是不宽于目标宽度，背景都应保持白色
+    img = Image.new("RGBA", (width, width * 3 // 4), (255, 255, 255, 0))
+    ImageDraw.Draw(img).rectangle([width // 4, width // 4, width // 2, width // 2], fill=(0, 0, 0, 255))
+    with io.BytesIO() as buf:
+        img.convert(mode).save(buf, format="PNG")
+        out = app.process_image_for_ai(io.BytesIO(buf.getvalue()))
+
+    assert out.mode == "RGB" and out.size[0] == app.AI_BASE_WIDTH
+    assert out.getpixel((5, 5)) == (255, 255, 255)
+    centre = app.AI_BASE_WIDTH * 3 // 8
+    assert out.getpixel((centre, centre)) == (0, 0, 0)